@@ -4,11 +4,32 @@ from datetime import datetime, timedelta
 import time
 from pathlib import Path
 from playwright.sync_api import sync_playwright
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 ECOBEE_API_BASE = "https://api.ecobee.com/1"
 
 
+def _create_session() -> requests.Session:
+    # transient gateway and connection errors are retried with exponential
+    # backoff by urllib3. a 500 is not: ecobee sends an expired token as one,
+    # and it should surface from raise_for_status() at once, like a 401
+    session = requests.Session()
+    retries = Retry(
+        total=3,
+        backoff_factor=2,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=["GET"],
+        raise_on_status=False,
+    )
+    session.mount("https://", HTTPAdapter(max_retries=retries))
+    return session
+
+
+_SESSION = _create_session()
+
+
 def _load_json(path: str) -> dict:
     p = Path(path)
     if p.exists():
@@ -22,7 +43,7 @@ def _load_json(path: str) -> dict:
 def _save_json(path: str, data: dict) -> None:
     p = Path(path)
     p.parent.mkdir(parents=True, exist_ok=True)
-    p.write_text(json.dumps(data, indent=2))
+    p.write_text(json.dumps(data, separators=(",", ":")))
 
 
 def load_token(token_file: str) -> str | None:
@@ -116,7 +137,7 @@ def extract_access_token(
 def get_thermostat_id(access_token: str) -> str:
     url = f"{ECOBEE_API_BASE}/user"
     headers = {"Authorization": f"Bearer {access_token}"}
-    resp = requests.get(url, headers=headers, timeout=30)
+    resp = _SESSION.get(url, headers=headers, timeout=30)
     resp.raise_for_status()
     data = resp.json()
     thermostat_list = data.get("user", {}).get("thermostatList", [])
@@ -151,7 +172,7 @@ def fetch_runtime_report(
         ),
     }
 
-    resp = requests.get(url, headers=headers, params=params, timeout=60)
+    resp = _SESSION.get(url, headers=headers, params=params, timeout=60)
     resp.raise_for_status()
     payload = resp.json()
 
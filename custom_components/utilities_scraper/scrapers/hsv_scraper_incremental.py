@@ -4,6 +4,8 @@ import time
 from datetime import datetime, timedelta
 from pathlib import Path
 import urllib.parse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 BASE_URL = "https://hsvutil.org"
 
@@ -25,7 +27,7 @@ def _load_json(path: str) -> dict:
 def _save_json(path: str, data: dict) -> None:
     p = Path(path)
     p.parent.mkdir(parents=True, exist_ok=True)
-    p.write_text(json.dumps(data, indent=2))
+    p.write_text(json.dumps(data, separators=(",", ":")))
 
 
 def load_token(token_file: str) -> str | None:
@@ -45,7 +47,17 @@ def save_token(token_file: str, token: str) -> None:
 
 
 def create_session(username: str, password: str, token_file: str) -> requests.Session | None:
+    # one keep-alive connection for the login and every usage call; transient
+    # gateway errors on the GETs are retried by urllib3, the login POST is not
     session = requests.Session()
+    retries = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=["GET"],
+        raise_on_status=False,
+    )
+    session.mount("https://", HTTPAdapter(max_retries=retries))
 
     token = load_token(token_file)
     if token:
@@ -1,13 +1,19 @@
 import requests
 import json
+import gzip
 from datetime import datetime, timedelta
-import time
 import os
+import sys
+import shutil
 from pathlib import Path
 from dotenv import load_dotenv
-import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from collections import defaultdict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pyotp
-from playwright.sync_api import sync_playwright
+from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
 
 load_dotenv()
 
@@ -19,12 +25,64 @@ STORE_INTERVAL = int(os.getenv("STORE_INTERVAL_MINUTES", "15"))
 
 SESSION_FILE = "ecobee_session.json"
 TOKEN_FILE = "ecobee_token.json"
+THERMOSTAT_FILE = "ecobee_thermostat.json"
+AVAILABILITY_FILE = "ecobee_availability.json"
 
-def save_token(token):
+# resolves once the portal has stored an access token anywhere the page can see
+TOKEN_PREDICATE = """
+    () => localStorage.getItem('access_token') ||
+         sessionStorage.getItem('access_token') ||
+         (document.cookie.match(/(?:^|;\\s*)[^=;]*token[^=;]*=([^;]+)/i) || [])[1] ||
+         null
+"""
+
+# ecobee access tokens live ~1h, trust a cached one for a bit less than that
+TOKEN_TTL = timedelta(minutes=55)
+
+# the start of a thermostat's history doesn't move, re-probe it monthly
+AVAILABILITY_TTL = timedelta(days=30)
+
+# concurrent requests, kept small to stay polite to the api
+PROBE_WORKERS = 3
+CHUNK_WORKERS = 4
+
+REPORT_COLUMNS = ("zoneHvacMode,zoneCalendarEvent,zoneCoolTemp,zoneHeatTemp,zoneAveTemp,zoneHumidity,"
+                  "outdoorTemp,outdoorHumidity,compCool1,compCool2,compHeat1,compHeat2,auxHeat1,auxHeat2,"
+                  "auxHeat3,fan,humidifier,dehumidifier,economizer,ventilator,hvacMode,zoneClimate")
+
+# availability probes only count rows and read dates, one column will do
+PROBE_COLUMNS = "zoneAveTemp"
+
+def create_api_session():
+    """one keep-alive session shared by every ecobee api call"""
+    session = requests.Session()
+    session.headers.update({
+        'Accept': 'application/json',
+        'User-Agent': 'PythonEcobeeScraper/1.0'
+    })
+    # no 500 here: ecobee reports an expired token as a 500 (status code 14),
+    # and retrying that with backoff only delays the re-login
+    retries = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 502, 503, 504],
+        respect_retry_after_header=True,  # 429s wait as long as ecobee asks
+        raise_on_status=False
+    )
+    # pool sized for the concurrent chunk/probe workers
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retries)
+    session.mount('https://', adapter)
+    return session
+
+API_SESSION = create_api_session()
+
+def save_token(token, issued=None):
+    """issued is when a fresh login produced the token; a token lifted from an
+    old browser session has no known age, so it is never treated as fresh"""
     with open(TOKEN_FILE, 'w') as f:
         json.dump({
             'access_token': token,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': issued.isoformat() if issued else None
         }, f)
 
 def load_token():
@@ -34,6 +92,56 @@ def load_token():
             return data.get('access_token')
     return None
 
+def token_is_fresh():
+    """true if the cached token was issued within TOKEN_TTL"""
+    if not os.path.exists(TOKEN_FILE):
+        return False
+    with open(TOKEN_FILE, 'r') as f:
+        data = json.load(f)
+    try:
+        issued = datetime.fromisoformat(data['timestamp'])
+    except (KeyError, TypeError, ValueError):
+        return False
+    return datetime.now() - issued < TOKEN_TTL
+
+def save_thermostat_id(thermostat_id):
+    with open(THERMOSTAT_FILE, 'w') as f:
+        json.dump({'thermostat_id': thermostat_id}, f)
+
+def load_thermostat_id():
+    if os.path.exists(THERMOSTAT_FILE):
+        with open(THERMOSTAT_FILE, 'r') as f:
+            return json.load(f).get('thermostat_id')
+    return None
+
+def load_cached_start(thermostat_id):
+    """earliest data date probed on an earlier run for this thermostat, None if stale"""
+    if not os.path.exists(AVAILABILITY_FILE):
+        return None
+    with open(AVAILABILITY_FILE, 'r') as f:
+        data = json.load(f)
+    try:
+        saved = datetime.fromisoformat(data['timestamp'])
+        start = datetime.fromisoformat(data['earliest_with_data'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if data.get('thermostat_id') != thermostat_id or datetime.now() - saved > AVAILABILITY_TTL:
+        return None
+    return start
+
+def save_cached_start(thermostat_id, start):
+    with open(AVAILABILITY_FILE, 'w') as f:
+        json.dump({
+            'thermostat_id': thermostat_id,
+            'earliest_with_data': start.isoformat(),
+            'timestamp': datetime.now().isoformat()
+        }, f)
+
+def clear_cached_auth():
+    for path in (TOKEN_FILE, SESSION_FILE, THERMOSTAT_FILE):
+        if os.path.exists(path):
+            os.remove(path)
+
 def authenticate_ecobee_browser():
     with sync_playwright() as p:
         browser = p.chromium.launch(headless=False)
@@ -53,7 +161,7 @@ def authenticate_ecobee_browser():
                     if token:
                         browser.close()
                         print("using cached session")
-                        return token
+                        return token, None
             except:
                 pass
         
@@ -100,20 +208,23 @@ def authenticate_ecobee_browser():
             input("enter 2fa code manually, press enter when done...")
         
         page.wait_for_url('**/consumerportal/**', timeout=30000)
+        issued = datetime.now()
         
         # save session
         context.storage_state(path=SESSION_FILE)
         
-        # get token
+        # get token, the intercepted callback is the fast path
         token = token_holder['token']
         
         if not token:
-            token = page.evaluate("""
-                () => localStorage.getItem('access_token') || 
-                     sessionStorage.getItem('access_token')
-            """)
+            # one in-page wait covering storage and readable cookies
+            try:
+                token = page.wait_for_function(TOKEN_PREDICATE, timeout=10000).json_value()
+            except PlaywrightTimeoutError:
+                token = None
         
         if not token:
+            # httponly cookies are invisible to document.cookie
             cookies = context.cookies()
             for cookie in cookies:
                 if 'token' in cookie['name'].lower():
@@ -126,11 +237,11 @@ def authenticate_ecobee_browser():
             raise RuntimeError("could not extract access token")
         
         print("login successful")
-        return token
+        return token, issued
 
 def get_thermostat_id(access_token):
     headers = {'Authorization': f'Bearer {access_token}'}
-    response = requests.get(
+    response = API_SESSION.get(
         "https://api.ecobee.com/1/user",
         params={"format": "json", "json": "{}"},
         headers=headers
@@ -139,64 +250,87 @@ def get_thermostat_id(access_token):
     user_data = response.json()
     return user_data['user']['defaultThermostatIdentifier']
 
+def count_report_rows(access_token, thermostat_id, start_date, end_date):
+    """number of rows in the first report for a window, 0 if it came back empty.
+    request errors propagate so a failed probe is never read as no data"""
+    data = get_thermostat_data(access_token, thermostat_id, start_date, end_date,
+                               columns=PROBE_COLUMNS, include_sensors=False)
+    
+    if data and 'reportList' in data and data['reportList']:
+        return len(data['reportList'][0].get('rowList', []))
+    return 0
+
 def check_data_availability(access_token, thermostat_id):
     print("\nchecking data availability...")
     
     end_date = datetime.now()
-    test_periods = [30, 90, 180, 365, 540, 730]
+    max_days = 730
     earliest_with_data = None
     
-    for days in test_periods:
+    def probe_window(days):
         test_start = end_date - timedelta(days=days)
-        test_end = min(test_start + timedelta(days=30), end_date)
-        
-        try:
-            data = get_thermostat_data(access_token, thermostat_id, test_start, test_end, retries=1, delay=0)
+        return test_start, min(test_start + timedelta(days=30), end_date)
+    
+    def has_data(days):
+        return count_report_rows(access_token, thermostat_id, *probe_window(days)) > 10
+    
+    # history is contiguous, so search for the oldest window with data instead
+    # of sweeping a fixed ladder: each round probes a few evenly spaced points
+    # side by side and narrows to the gap between the last hit and first miss
+    lo, hi = 0, max_days + 1
+    with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as executor:
+        while hi - lo > 30:
+            step = (hi - lo) / (PROBE_WORKERS + 1)
+            points = sorted({lo + round(step * i) for i in range(1, PROBE_WORKERS + 1)})
             
-            if data and 'reportList' in data and data['reportList']:
-                report = data['reportList'][0]
-                if 'rowList' in report and len(report['rowList']) > 10:
-                    earliest_with_data = test_start
-                    print(f"  data found at {test_start.date()} ({days} days)")
-        except:
-            pass
-        
-        time.sleep(0.3)
+            for days, found in zip(points, executor.map(has_data, points)):
+                if not found:
+                    hi = days
+                    break
+                lo = days
+                earliest_with_data = probe_window(days)[0]
+                print(f"  data found at {earliest_with_data.date()} ({days} days)")
+    
+    def first_row_date(month_start, month_end):
+        data = get_thermostat_data(access_token, thermostat_id, month_start, month_end,
+                                   columns=PROBE_COLUMNS, include_sensors=False)
+        if data and 'reportList' in data and data['reportList']:
+            report = data['reportList'][0]
+            if 'rowList' in report and len(report['rowList']) > 0:
+                first_row = report['rowList'][0]
+                parts = first_row if isinstance(first_row, list) else first_row.split(',')
+                if len(parts) >= 2:
+                    return datetime.strptime(parts[0], "%Y-%m-%d")
+        return None
     
     if earliest_with_data:
-        month_start = earliest_with_data
-        month_end = min(month_start + timedelta(days=31), end_date)
-        
-        try:
-            data = get_thermostat_data(access_token, thermostat_id, month_start, month_end, retries=1, delay=0)
-            if data and 'reportList' in data and data['reportList']:
-                report = data['reportList'][0]
-                if 'rowList' in report and len(report['rowList']) > 0:
-                    first_row = report['rowList'][0]
-                    parts = first_row if isinstance(first_row, list) else first_row.split(',')
-                    if len(parts) >= 2:
-                        actual_start = datetime.strptime(parts[0], "%Y-%m-%d")
-                        days_available = (end_date - actual_start).days
-                        print(f"earliest data: {actual_start.date()}")
-                        print(f"total days available: {days_available}")
-                        return actual_start, days_available
-        except:
-            pass
+        # the window at hi had (next to) no rows and the one at lo had plenty,
+        # so the real start lies between the start of the first and the end of
+        # the second. walk that stretch a month at a time, oldest first; the
+        # first row found is the start. if every probe hit, begin at max_days
+        # like the old fixed ladder did
+        month_start = end_date - timedelta(days=min(hi, max_days))
+        bracket_end = min(end_date - timedelta(days=lo - 30), end_date)
+        while month_start < bracket_end:
+            month_end = min(month_start + timedelta(days=31), end_date)
+            actual_start = first_row_date(month_start, month_end)
+            if actual_start:
+                days_available = (end_date - actual_start).days
+                print(f"earliest data: {actual_start.date()}")
+                print(f"total days available: {days_available}")
+                return actual_start, days_available
+            month_start = month_end
         
         days_available = (end_date - earliest_with_data).days
         print(f"earliest data: ~{earliest_with_data.date()}")
         print(f"total days available: ~{days_available}")
         return earliest_with_data, days_available
     
-    print("no historical data found, defaulting to 30 days")
-    return end_date - timedelta(days=30), 30
+    return None
 
-def get_thermostat_data(access_token, thermostat_id, start_date, end_date, retries=3, delay=5):
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Accept': 'application/json',
-        'User-Agent': 'PythonEcobeeScraper/1.0'
-    }
+def get_thermostat_data(access_token, thermostat_id, start_date, end_date,
+                        columns=REPORT_COLUMNS, include_sensors=True):
+    headers = {'Authorization': f'Bearer {access_token}'}
 
     start_date_str = start_date.strftime("%Y-%m-%d")
     end_date_str = end_date.strftime("%Y-%m-%d")
@@ -210,60 +344,55 @@ def get_thermostat_data(access_token, thermostat_id, start_date, end_date, retri
         "endDate": end_date_str,
         "startInterval": 0,
         "endInterval": 287,
-        "columns": "zoneHvacMode,zoneCalendarEvent,zoneCoolTemp,zoneHeatTemp,zoneAveTemp,zoneHumidity,"
-                   "outdoorTemp,outdoorHumidity,compCool1,compCool2,compHeat1,compHeat2,auxHeat1,auxHeat2,"
-                   "auxHeat3,fan,humidifier,dehumidifier,economizer,ventilator,hvacMode,zoneClimate",
-        "includeSensors": True
+        "columns": columns,
+        "includeSensors": include_sensors
     }
 
-    payload_str = json.dumps(payload_dict)
-    url = f"https://api.ecobee.com/1/runtimeReport?format=json&body={urllib.parse.quote(payload_str)}"
+    # compact body, quoted by requests; the timeout keeps a hung server from
+    # stalling the run
+    params = {"format": "json", "body": json.dumps(payload_dict, separators=(',', ':'))}
 
-    for attempt in range(retries):
-        try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            return response.json()
-        except requests.HTTPError as e:
-            if e.response.status_code == 500 and attempt < retries - 1:
-                time.sleep(delay)
-            elif e.response.status_code == 401:
-                raise
-            else:
-                raise
+    # gateway errors and 429s are retried by the session adapter
+    response = API_SESSION.get(
+        "https://api.ecobee.com/1/runtimeReport",
+        params=params,
+        headers=headers,
+        timeout=(5, 30)
+    )
+    response.raise_for_status()
+    return response.json()
+
+@lru_cache(maxsize=4)
+def split_columns(columns):
+    """column names for a report header, interned so every reading shares the key strings"""
+    return tuple(sys.intern(column) for column in columns.split(','))
 
 def process_data(data, store_interval_minutes=15):
     if not data or 'reportList' not in data:
         return {}
 
-    skip = store_interval_minutes // 5
-    columns = data['columns'].split(',')
+    # report rows are 5 minutes apart, keep every skip-th one
+    skip = max(1, store_interval_minutes // 5)
+    columns = split_columns(data['columns'])
     processed = {"THERMOSTAT": []}
 
     for report in data['reportList']:
         thermostat_id = report['thermostatIdentifier']
         readings = []
 
-        for idx, row in enumerate(report['rowList']):
-            if idx % skip != 0:
-                continue
-
+        for row in report['rowList'][::skip]:
             parts = row if isinstance(row, list) else row.split(',')
             if len(parts) < 2:
                 continue
 
-            dt = datetime.strptime(f"{parts[0]} {parts[1]}", "%Y-%m-%d %H:%M:%S")
-            reading = {
+            # rows are "YYYY-MM-DD,HH:MM:SS,...", fromisoformat parses that in C
+            dt = datetime.fromisoformat(f"{parts[0]}T{parts[1]}")
+            readings.append({
                 "timestamp": int(dt.timestamp() * 1000),
                 "datetime": dt.isoformat(),
-                "data": {}
-            }
-
-            for i, column in enumerate(columns):
-                if i + 2 < len(parts):
-                    reading["data"][column] = parts[i + 2]
-
-            readings.append(reading)
+                # zip stops at the shorter side, so short rows just drop columns
+                "data": dict(zip(columns, parts[2:]))
+            })
 
         processed["THERMOSTAT"].append({
             "thermostatId": thermostat_id,
@@ -275,58 +404,94 @@ def process_data(data, store_interval_minutes=15):
 
 def fetch_data_in_chunks(access_token, thermostat_id, start_date, end_date, chunk_size, store_interval_minutes):
     all_data = {"THERMOSTAT": []}
+    chunks_by_thermostat = defaultdict(list)
+    
+    # build every window up front (newest first) so they can be fetched together
+    windows = []
     current_end = end_date
-    chunk_num = 1
-    total_chunks = ((end_date - start_date).days // chunk_size) + 1
+    while current_end > start_date:
+        current_start = max(current_end - timedelta(days=chunk_size - 1), start_date)
+        windows.append((current_start, current_end))
+        current_end = current_start - timedelta(days=1)
     
+    total_chunks = len(windows)
     print(f"\nfetching data in {total_chunks} chunks...")
     
-    while current_end > start_date:
-        current_start = max(current_end - timedelta(days=chunk_size - 1), start_date)
-        
-        print(f"  chunk {chunk_num}/{total_chunks}: {current_start.date()} to {current_end.date()}", end="", flush=True)
+    with ThreadPoolExecutor(max_workers=CHUNK_WORKERS) as executor:
+        futures = [
+            executor.submit(get_thermostat_data, access_token, thermostat_id, window_start, window_end)
+            for window_start, window_end in windows
+        ]
         
-        try:
-            raw_chunk = get_thermostat_data(access_token, thermostat_id, current_start, current_end)
-            processed_chunk = process_data(raw_chunk, store_interval_minutes=store_interval_minutes)
-            
-            for t in processed_chunk.get("THERMOSTAT", []):
-                existing = next((x for x in all_data["THERMOSTAT"] if x["thermostatId"] == t["thermostatId"]), None)
-                if existing:
-                    existing["readings"] = t["readings"] + existing["readings"]
-                    existing["totalReadings"] = len(existing["readings"])
-                else:
-                    all_data["THERMOSTAT"].append(t)
-            
-            readings_count = len(processed_chunk.get("THERMOSTAT", [{}])[0].get("readings", []))
-            print(f" - {readings_count} readings")
+        # merge in submission order so readings stay chronological
+        for chunk_num, ((current_start, current_end), future) in enumerate(zip(windows, futures), 1):
+            label = f"  chunk {chunk_num}/{total_chunks}: {current_start.date()} to {current_end.date()}"
             
-        except Exception as e:
-            print(f" - error: {e}")
-            if "401" in str(e):
-                raise
-        
-        current_end = current_start - timedelta(days=1)
-        chunk_num += 1
-        time.sleep(0.5)
+            try:
+                raw_chunk = future.result()
+                processed_chunk = process_data(raw_chunk, store_interval_minutes=store_interval_minutes)
+                
+                for t in processed_chunk.get("THERMOSTAT", []):
+                    chunks_by_thermostat[t["thermostatId"]].append(t["readings"])
+                
+                readings_count = len(processed_chunk.get("THERMOSTAT", [{}])[0].get("readings", []))
+                print(f"{label} - {readings_count} readings")
+                
+            except Exception as e:
+                print(f"{label} - error: {e}")
+                if "401" in str(e):
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+    
+    # chunks were collected newest first, stitch each thermostat's readings
+    # back together oldest first in one pass
+    for tid, chunks in chunks_by_thermostat.items():
+        readings = [reading for chunk in reversed(chunks) for reading in chunk]
+        all_data["THERMOSTAT"].append({
+            "thermostatId": tid,
+            "totalReadings": len(readings),
+            "readings": readings
+        })
     
     return all_data
 
+def compress_backups(data_dir):
+    """gzip every backup but the newest; none are ever deleted"""
+    # names end in the timestamp, so name order is save order
+    backups = sorted(data_dir.glob("ecobee_data_*.json*"))
+    
+    for path in backups[:-1]:
+        if path.suffix == ".json":
+            with open(path, 'rb') as src, gzip.open(f"{path}.gz", 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            path.unlink()
+
 def save_data(data):
     """save data to json file"""
     data_dir = Path("data/ecobee")
     data_dir.mkdir(parents=True, exist_ok=True)
     
-    # save as current file for incremental updates
+    payload = json.dumps(data, separators=(',', ':'))
+    
+    # current file, which ecobee_scraper_incremental merges into
     current_file = data_dir / "ecobee_current.json"
-    with open(current_file, 'w') as f:
-        json.dump(data, f, indent=2)
+    tmp_file = current_file.with_suffix(".json.tmp")
+    tmp_file.write_text(payload)
+    os.replace(tmp_file, current_file)
     
-    # also save timestamped backup
+    # also save timestamped backup, linked rather than copied; the incremental
+    # scraper replaces the current file too, so the link never changes under it
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     backup_file = data_dir / f"ecobee_data_{timestamp}.json"
-    with open(backup_file, 'w') as f:
-        json.dump(data, f, indent=2)
+    try:
+        os.link(current_file, backup_file)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copyfile(current_file, backup_file)
+    
+    compress_backups(data_dir)
     
     print(f"\ndata saved to {current_file}")
     print(f"backup saved to {backup_file}")
@@ -362,30 +527,47 @@ def main():
     access_token = load_token()
     needs_auth = True
     
-    if access_token:
+    # a token issued minutes ago is still good, skip the /user round trip
+    thermostat_id = load_thermostat_id() if access_token and token_is_fresh() else None
+    
+    if thermostat_id:
+        print("using cached token")
+        print(f"thermostat: {thermostat_id}")
+        needs_auth = False
+    elif access_token:
         try:
             thermostat_id = get_thermostat_id(access_token)
-            print(f"using cached token")
+            save_thermostat_id(thermostat_id)
+            print("using cached token")
             print(f"thermostat: {thermostat_id}")
             needs_auth = False
         except:
-            if os.path.exists(TOKEN_FILE):
-                os.remove(TOKEN_FILE)
-            if os.path.exists(SESSION_FILE):
-                os.remove(SESSION_FILE)
+            clear_cached_auth()
     
     if needs_auth:
-        access_token = authenticate_ecobee_browser()
-        save_token(access_token)
+        access_token, issued = authenticate_ecobee_browser()
+        save_token(access_token, issued)
         thermostat_id = get_thermostat_id(access_token)
+        save_thermostat_id(thermostat_id)
         print(f"thermostat: {thermostat_id}")
 
     # date range
     end_date = datetime.now()
     
     if DATA_PERIOD_DAYS < 0:
-        actual_start, days_available = check_data_availability(access_token, thermostat_id)
-        start_date = actual_start
+        start_date = load_cached_start(thermostat_id)
+        if start_date:
+            days_available = (end_date - start_date).days
+            print(f"\nearliest data: {start_date.date()} (cached)")
+        else:
+            found = check_data_availability(access_token, thermostat_id)
+            if found:
+                start_date, days_available = found
+                save_cached_start(thermostat_id, start_date)
+            else:
+                # nothing to remember, the next run searches again
+                print("no historical data found, defaulting to 30 days")
+                start_date, days_available = end_date - timedelta(days=30), 30
         print(f"\nfetching all available data ({days_available} days)")
     else:
         print(f"\nfetching last {DATA_PERIOD_DAYS} days")
@@ -415,6 +597,9 @@ def main():
         
     except Exception as e:
         if "401" in str(e):
+            # forget the token so the next run re-authenticates instead of trusting it
+            if os.path.exists(TOKEN_FILE):
+                os.remove(TOKEN_FILE)
             print("\ntoken expired, please run again")
         raise
 
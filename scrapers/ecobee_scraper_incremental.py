@@ -1,11 +1,13 @@
 import requests
 import json
 from datetime import datetime, timedelta
-import time
 import os
+import shutil
 from pathlib import Path
 from dotenv import load_dotenv
-import urllib.parse
+from operator import itemgetter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pyotp
 from playwright.sync_api import sync_playwright
 
@@ -16,15 +18,45 @@ PASSWORD = os.getenv("ECOBEE_PASSWORD")
 TOTP_SECRET = os.getenv("ECOBEE_TOTP_SECRET")
 STORE_INTERVAL = int(os.getenv("STORE_INTERVAL_MINUTES", "15"))
 
-SESSION_FILE = "ecobee_session.json"
+PROFILE_DIR = Path(".cache/ecobee_profile")
 TOKEN_FILE = "ecobee_token.json"
+THERMOSTAT_FILE = "ecobee_thermostat.json"
 DATA_FILE = "data/ecobee/ecobee_current.json"
 
-def save_token(token):
+# same window as ecobee_scraper, which shares the token file
+TOKEN_TTL = timedelta(minutes=55)
+
+# ecobee answers an expired token with a 500 carrying this api status code
+TOKEN_EXPIRED_CODE = 14
+
+def create_api_session():
+    """one keep-alive session shared by every ecobee api call"""
+    session = requests.Session()
+    session.headers.update({
+        'Accept': 'application/json',
+        'User-Agent': 'PythonEcobeeScraper/1.0'
+    })
+    # no 500 here: an expired token comes back as a 500 with code 14, which
+    # main needs to see right away rather than after the backoff
+    retries = Retry(
+        total=3,
+        backoff_factor=2,
+        status_forcelist=[502, 503],
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retries)
+    session.mount('https://', adapter)
+    return session
+
+API_SESSION = create_api_session()
+
+def save_token(token, issued=None):
+    """issued is when a fresh login produced the token; a token lifted from an
+    old browser session has no known age, so it is never treated as fresh"""
     with open(TOKEN_FILE, 'w') as f:
         json.dump({
             'access_token': token,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': issued.isoformat() if issued else None
         }, f)
 
 def load_token():
@@ -34,27 +66,70 @@ def load_token():
             return data.get('access_token')
     return None
 
+def token_is_fresh():
+    """true if the cached token was issued within TOKEN_TTL"""
+    if not os.path.exists(TOKEN_FILE):
+        return False
+    with open(TOKEN_FILE, 'r') as f:
+        data = json.load(f)
+    try:
+        issued = datetime.fromisoformat(data['timestamp'])
+    except (KeyError, TypeError, ValueError):
+        return False
+    return datetime.now() - issued < TOKEN_TTL
+
+def save_thermostat_id(thermostat_id):
+    with open(THERMOSTAT_FILE, 'w') as f:
+        json.dump({'thermostat_id': thermostat_id}, f)
+
+def load_thermostat_id():
+    if os.path.exists(THERMOSTAT_FILE):
+        with open(THERMOSTAT_FILE, 'r') as f:
+            return json.load(f).get('thermostat_id')
+    return None
+
+def clear_cached_token():
+    for path in (TOKEN_FILE, THERMOSTAT_FILE):
+        if os.path.exists(path):
+            os.remove(path)
+
+def clear_cached_auth():
+    clear_cached_token()
+    shutil.rmtree(PROFILE_DIR, ignore_errors=True)
+
+def token_expired(response):
+    """true if an api error response says the token aged out"""
+    try:
+        return response.json()["status"]["code"] == TOKEN_EXPIRED_CODE
+    except (ValueError, KeyError, TypeError):
+        return False
+
 def authenticate_ecobee_browser():
     with sync_playwright() as p:
-        browser = p.chromium.launch(headless=False)
+        # persistent profile keeps cookies/localStorage on disk between runs,
+        # so no storage_state json to reload. it is only read for a silent
+        # token; a login that fails halfway never runs in it
+        context = p.chromium.launch_persistent_context(user_data_dir=PROFILE_DIR, headless=True)
+        page = context.pages[0] if context.pages else context.new_page()
         
-        if os.path.exists(SESSION_FILE):
-            try:
-                context = browser.new_context(storage_state=SESSION_FILE)
-                page = context.new_page()
-                page.goto('https://www.ecobee.com/consumerportal/index.html', timeout=15000)
-                
-                if 'consumerportal' in page.url:
-                    token = page.evaluate("""
-                        () => localStorage.getItem('access_token') || 
-                             sessionStorage.getItem('access_token')
-                    """)
-                    if token:
-                        browser.close()
-                        return token
-            except:
-                pass
+        try:
+            page.goto('https://www.ecobee.com/consumerportal/index.html', timeout=15000)
+            
+            if 'consumerportal' in page.url:
+                token = page.evaluate("""
+                    () => localStorage.getItem('access_token') || 
+                         sessionStorage.getItem('access_token')
+                """)
+                if token:
+                    return token, None
+        except:
+            pass
+        finally:
+            context.close()
         
+        # fresh login in a clean, throwaway context. headless unless the 2fa
+        # code has to be typed into the browser by hand
+        browser = p.chromium.launch(headless=bool(TOTP_SECRET))
         context = browser.new_context()
         page = context.new_page()
         
@@ -93,7 +168,7 @@ def authenticate_ecobee_browser():
             input("enter 2fa code manually, press enter when done...")
         
         page.wait_for_url('**/consumerportal/**', timeout=30000)
-        context.storage_state(path=SESSION_FILE)
+        issued = datetime.now()
         
         token = token_holder['token']
         
@@ -103,8 +178,8 @@ def authenticate_ecobee_browser():
                      sessionStorage.getItem('access_token')
             """)
         
+        cookies = context.cookies()
         if not token:
-            cookies = context.cookies()
             for cookie in cookies:
                 if 'token' in cookie['name'].lower():
                     token = cookie['value']
@@ -115,11 +190,18 @@ def authenticate_ecobee_browser():
         if not token:
             raise RuntimeError("could not extract access token")
         
-        return token
+        # start the profile over from this login's cookies so the next run
+        # can take the silent path
+        shutil.rmtree(PROFILE_DIR, ignore_errors=True)
+        context = p.chromium.launch_persistent_context(user_data_dir=PROFILE_DIR, headless=True)
+        context.add_cookies(cookies)
+        context.close()
+        
+        return token, issued
 
 def get_thermostat_id(access_token):
     headers = {'Authorization': f'Bearer {access_token}'}
-    response = requests.get(
+    response = API_SESSION.get(
         "https://api.ecobee.com/1/user",
         params={"format": "json", "json": "{}"},
         headers=headers
@@ -129,11 +211,7 @@ def get_thermostat_id(access_token):
     return user_data['user']['defaultThermostatIdentifier']
 
 def get_thermostat_data(access_token, thermostat_id, start_date, end_date):
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Accept': 'application/json',
-        'User-Agent': 'PythonEcobeeScraper/1.0'
-    }
+    headers = {'Authorization': f'Bearer {access_token}'}
 
     payload_dict = {
         "selection": {
@@ -150,26 +228,23 @@ def get_thermostat_data(access_token, thermostat_id, start_date, end_date):
         "includeSensors": True
     }
 
-    url = f"https://api.ecobee.com/1/runtimeReport?format=json&body={urllib.parse.quote(json.dumps(payload_dict))}"
+    params = {"format": "json", "body": json.dumps(payload_dict, separators=(',', ':'))}
 
-    for attempt in range(3):
-        try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            return response.json()
-        except requests.HTTPError as e:
-            if e.response.status_code == 500 and attempt < 2:
-                time.sleep(5)
-            elif e.response.status_code == 401:
-                raise
-            else:
-                raise
+    # a hung request mustn't hold up the scheduled run
+    response = API_SESSION.get(
+        "https://api.ecobee.com/1/runtimeReport",
+        params=params,
+        headers=headers,
+        timeout=(5, 30)
+    )
+    response.raise_for_status()
+    return response.json()
 
 def process_data(data, store_interval_minutes=15):
     if not data or 'reportList' not in data:
         return {}
 
-    skip = store_interval_minutes // 5
+    skip = max(1, store_interval_minutes // 5)
     columns = data['columns'].split(',')
     processed = {"THERMOSTAT": []}
 
@@ -177,26 +252,17 @@ def process_data(data, store_interval_minutes=15):
         thermostat_id = report['thermostatIdentifier']
         readings = []
 
-        for idx, row in enumerate(report['rowList']):
-            if idx % skip != 0:
-                continue
-
+        for row in report['rowList'][::skip]:
             parts = row if isinstance(row, list) else row.split(',')
             if len(parts) < 2:
                 continue
 
-            dt = datetime.strptime(f"{parts[0]} {parts[1]}", "%Y-%m-%d %H:%M:%S")
-            reading = {
+            dt = datetime.fromisoformat(f"{parts[0]}T{parts[1]}")
+            readings.append({
                 "timestamp": int(dt.timestamp() * 1000),
                 "datetime": dt.isoformat(),
-                "data": {}
-            }
-
-            for i, column in enumerate(columns):
-                if i + 2 < len(parts):
-                    reading["data"][column] = parts[i + 2]
-
-            readings.append(reading)
+                "data": dict(zip(columns, parts[2:]))
+            })
 
         processed["THERMOSTAT"].append({
             "thermostatId": thermostat_id,
@@ -208,9 +274,9 @@ def process_data(data, store_interval_minutes=15):
 
 def load_existing_data():
     """load existing data file"""
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, 'r') as f:
-            return json.load(f)
+    data_file = Path(DATA_FILE)
+    if data_file.exists():
+        return json.loads(data_file.read_bytes())
     return {"THERMOSTAT": []}
 
 def get_last_timestamp(data):
@@ -229,34 +295,35 @@ def get_last_timestamp(data):
 def merge_data(existing, new_data):
     """merge new data into existing, removing duplicates"""
     if not new_data.get("THERMOSTAT"):
-        return existing
+        return existing, 0
     
     new_thermostat = new_data["THERMOSTAT"][0]
     new_readings = new_thermostat.get("readings", [])
     
     if not new_readings:
-        return existing
+        return existing, 0
     
     # get or create thermostat entry
     if not existing.get("THERMOSTAT"):
         existing["THERMOSTAT"] = [new_thermostat]
-        return existing
+        return existing, len(new_readings)
     
     existing_thermostat = existing["THERMOSTAT"][0]
     existing_readings = existing_thermostat.get("readings", [])
+    by_timestamp = itemgetter("timestamp")
     
-    # create set of existing timestamps for deduplication
+    # the fetch overlaps the last day, drop readings already stored
     existing_timestamps = {r["timestamp"] for r in existing_readings}
+    new_by_ts = {r["timestamp"]: r for r in new_readings if r["timestamp"] not in existing_timestamps}
+    new_only = sorted(new_by_ts.values(), key=by_timestamp)
+    added = len(new_only)
     
-    # add only new readings
-    added = 0
-    for reading in new_readings:
-        if reading["timestamp"] not in existing_timestamps:
-            existing_readings.append(reading)
-            added += 1
-    
-    # sort by timestamp
-    existing_readings.sort(key=lambda x: x["timestamp"])
+    # incremental runs almost always land after the last stored reading, so
+    # append the sorted tail; only fall back to a full sort on overlap
+    if not existing_readings or (new_only and new_only[0]["timestamp"] > existing_readings[-1]["timestamp"]):
+        existing_readings.extend(new_only)
+    elif new_only:
+        existing_readings = sorted(existing_readings + new_only, key=by_timestamp)
     
     # update counts
     existing_thermostat["readings"] = existing_readings
@@ -269,8 +336,11 @@ def save_data(data):
     data_dir = Path(DATA_FILE).parent
     data_dir.mkdir(parents=True, exist_ok=True)
     
-    with open(DATA_FILE, 'w') as f:
-        json.dump(data, f, indent=2)
+    # replaced, never rewritten in place: ecobee_scraper's newest backup is
+    # a hard link to this file
+    tmp_file = Path(DATA_FILE + '.tmp')
+    tmp_file.write_text(json.dumps(data, separators=(',', ':')))
+    os.replace(tmp_file, DATA_FILE)
 
 def main():
     print("ecobee incremental scraper")
@@ -280,21 +350,36 @@ def main():
     access_token = load_token()
     needs_auth = True
     
-    if access_token:
+    # a token issued minutes ago is still good, skip the /user round trip;
+    # a 401 on the data fetch below still clears it
+    thermostat_id = load_thermostat_id() if access_token and token_is_fresh() else None
+    
+    if thermostat_id:
+        needs_auth = False
+    elif access_token:
         try:
             thermostat_id = get_thermostat_id(access_token)
+            save_thermostat_id(thermostat_id)
             needs_auth = False
-        except:
-            if os.path.exists(TOKEN_FILE):
-                os.remove(TOKEN_FILE)
-            if os.path.exists(SESSION_FILE):
-                os.remove(SESSION_FILE)
+        except requests.HTTPError as e:
+            response = e.response
+            if response is not None and response.status_code in (401, 403):
+                # token refused outright, the saved browser login may be bad too
+                clear_cached_auth()
+            elif response is not None and token_expired(response):
+                # token just aged out, the browser profile can mint a new one
+                # without going through 2fa again
+                clear_cached_token()
+            else:
+                # timeouts and lasting 5xx say nothing about the login
+                raise
     
     if needs_auth:
         print("authenticating...")
-        access_token = authenticate_ecobee_browser()
-        save_token(access_token)
+        access_token, issued = authenticate_ecobee_browser()
+        save_token(access_token, issued)
         thermostat_id = get_thermostat_id(access_token)
+        save_thermostat_id(thermostat_id)
     
     # load existing data
     existing_data = load_existing_data()
@@ -322,8 +407,9 @@ def main():
         # merge with existing
         merged_data, added = merge_data(existing_data, new_data)
         
-        # save
-        save_data(merged_data)
+        # an unchanged history isn't rewritten
+        if added:
+            save_data(merged_data)
         
         # print summary
         total = merged_data["THERMOSTAT"][0]["totalReadings"] if merged_data.get("THERMOSTAT") else 0
@@ -338,6 +424,8 @@ def main():
         
     except Exception as e:
         if "401" in str(e):
+            if os.path.exists(TOKEN_FILE):
+                os.remove(TOKEN_FILE)
             print("token expired, will reauth next run")
         else:
             print(f"error: {e}")
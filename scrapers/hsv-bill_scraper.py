@@ -1,90 +1,17 @@
 import requests
 import json
-import time
 from datetime import datetime
 from pathlib import Path
-from dotenv import load_dotenv
 import os
-import urllib.parse
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from hsv_common import (
+    BASE_URL,
+    create_session,
+    login_and_get_account,
+)
 
-load_dotenv()
-USERNAME = os.getenv("HSV_USERNAME")
-PASSWORD = os.getenv("HSV_PASSWORD")
-BASE_URL = "https://hsvutil.smarthub.coop"
-TOKEN_FILE = "hsv_token.json"
-
-def save_token(token_data):
-    with open(TOKEN_FILE, 'w') as f:
-        json.dump({
-            'token': token_data['authorizationToken'],
-            'expiration': token_data['expiration'],
-            'timestamp': datetime.now().isoformat()
-        }, f)
-
-def load_token():
-    if os.path.exists(TOKEN_FILE):
-        with open(TOKEN_FILE, 'r') as f:
-            data = json.load(f)
-            exp = datetime.fromtimestamp(data['expiration'] / 1000)
-            if exp > datetime.now():
-                return data['token']
-    return None
-
-def create_session():
-    """create authenticated session"""
-    session = requests.Session()
-    
-    # try existing token
-    token = load_token()
-    if token:
-        session.headers.update({'Authorization': f'Bearer {token}'})
-        try:
-            response = session.get(f"{BASE_URL}/services/secured/accounts", params={"user": USERNAME})
-            if response.status_code == 200:
-                print("using cached token")
-                return session
-        except:
-            pass
-    
-    # fresh login
-    response = session.post(
-        f"{BASE_URL}/login", 
-        data={"username": USERNAME, "password": PASSWORD},
-        headers={"User-Agent": "Mozilla/5.0"}, 
-        allow_redirects=True
-    )
-    if not ("/ui/" in response.url or "dashboard" in response.url.lower()):
-        print("login failed")
-        return None
-    
-    # get oauth token
-    response = session.post(
-        f"{BASE_URL}/services/oauth/auth/v2",
-        data=f"userId={urllib.parse.quote(USERNAME)}&password={urllib.parse.quote(PASSWORD)}",
-        headers={"Content-Type": "application/x-www-form-urlencoded"}
-    )
-    if response.status_code != 200:
-        print("oauth failed")
-        return None
-    
-    token_data = response.json()
-    token = token_data.get("authorizationToken")
-    if not token:
-        print("no token")
-        return None
-    
-    save_token(token_data)
-    session.headers.update({'Authorization': f'Bearer {token}'})
-    print("login successful")
-    return session
-
-def get_account_info(session):
-    """get account number"""
-    response = session.get(f"{BASE_URL}/services/secured/accounts", params={"user": USERNAME})
-    accounts = response.json()
-    account_number = str(accounts[0]["account"])
-    print(f"account: {account_number}")
-    return account_number
+DOWNLOAD_WORKERS = 4
 
 def get_billing_history(session, account_number):
     """get list of all bills"""
@@ -94,20 +21,28 @@ def get_billing_history(session, account_number):
     )
     return response.json()
 
-def download_bill_pdf(session, bill_data, output_dir="data/bills"):
+def bill_date(bill_data):
+    return datetime.fromtimestamp(bill_data["billingDateTimestamp"] / 1000)
+
+def bill_filename(bill_data, date=None):
+    """pdf filename for a bill, e.g. 2024_03_7_123456.pdf"""
+    if date is None:
+        date = bill_date(bill_data)
+    return f"{date.year}_{date.month:02d}_{date.day}_{bill_data['acctNbr']}.pdf"
+
+def download_bill_pdf(session, bill_data, output_dir="data/bills", filename=None):
     """download single bill pdf"""
     account = bill_data["acctNbr"]
     timestamp = bill_data["billingDateTimestamp"]
     uuid = bill_data["billProcessUuid"]
     system = bill_data["systemOfRecord"]
     
-    # generate filename
-    date = datetime.fromtimestamp(timestamp / 1000)
-    filename = f"{date.year}_{str(date.month).zfill(2)}_{date.day}_{account}.pdf"
+    if filename is None:
+        filename = bill_filename(bill_data)
     
-    # check if already exists
+    # check if already exists; an empty file is a failed download, fetch it again
     filepath = Path(output_dir) / filename
-    if filepath.exists():
+    if filepath.exists() and filepath.stat().st_size > 0:
         return filepath, True  # already downloaded
     
     url = f"{BASE_URL}/services/secured/billPdfService/{filename}"
@@ -118,30 +53,43 @@ def download_bill_pdf(session, bill_data, output_dir="data/bills"):
         "systemOfRecord": system
     }
     
-    response = session.get(url, params=params)
-    
-    if response.status_code == 200:
+    # stream the body to disk instead of holding the whole pdf in memory
+    with session.get(url, params=params, stream=True) as response:
+        if response.status_code != 200:
+            return None, False
+        
         Path(output_dir).mkdir(parents=True, exist_ok=True)
-        with open(filepath, "wb") as f:
-            f.write(response.content)
-        return filepath, False  # newly downloaded
-    
-    return None, False
+        # write to a .part file first so an interrupted download isn't
+        # mistaken for an existing bill next run
+        part_file = filepath.with_suffix(".pdf.part")
+        response.raw.decode_content = True
+        with open(part_file, "wb") as f:
+            shutil.copyfileobj(response.raw, f, length=64 * 1024)
+        os.replace(part_file, filepath)
+    
+    return filepath, False  # newly downloaded
 
 def save_billing_data(bills, output_dir="data/bills"):
     """save billing data json"""
     Path(output_dir).mkdir(parents=True, exist_ok=True)
     
-    # save as current file
+    payload = json.dumps(bills, separators=(',', ':'))
+    
+    # save as current file; the billing history is rewritten whole each run
     current_file = Path(output_dir) / "billing_history_current.json"
-    with open(current_file, "w") as f:
-        json.dump(bills, f, indent=2)
+    tmp_file = current_file.with_suffix(".json.tmp")
+    tmp_file.write_text(payload)
+    os.replace(tmp_file, current_file)
     
     # also save timestamped backup
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     backup_file = Path(output_dir) / f"billing_history_{timestamp}.json"
-    with open(backup_file, "w") as f:
-        json.dump(bills, f, indent=2)
+    try:
+        os.link(current_file, backup_file)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copyfile(current_file, backup_file)
     
     print(f"\ndata saved to {current_file}")
     print(f"backup saved to {backup_file}")
@@ -173,7 +121,12 @@ def main():
         print("\nauthentication failed")
         return
     
-    account_number = get_account_info(session)
+    session, account_info = login_and_get_account(session)
+    if account_info is None:
+        print("\nauthentication failed")
+        return
+    account_number = account_info[0]
+    print(f"account: {account_number}")
     
     print("\nfetching billing history...")
     bills = get_billing_history(session, account_number)
@@ -183,10 +136,32 @@ def main():
     downloaded = 0
     skipped = 0
     
+    # drop bills already on disk before any http work
+    existing = {p.name for p in Path("data/bills").glob("*.pdf") if p.stat().st_size > 0}
+    # work out each bill's date and filename once
+    viewable = []
     for bill in bills:
         if bill.get("showViewBillLink"):
-            date = datetime.fromtimestamp(bill["billingDateTimestamp"] / 1000)
-            filepath, exists = download_bill_pdf(session, bill)
+            date = bill_date(bill)
+            viewable.append((bill, date, bill_filename(bill, date)))
+    to_fetch = [item for item in viewable if item[2] not in existing]
+    skipped = len(viewable) - len(to_fetch)
+    if skipped:
+        print(f"  skipped {skipped} existing")
+    
+    # downloads are network bound, so run a few at once over the pooled session
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        futures = {
+            executor.submit(download_bill_pdf, session, bill, filename=filename): (bill, date)
+            for bill, date, filename in to_fetch
+        }
+        
+        for future in as_completed(futures):
+            bill, date = futures[future]
+            try:
+                filepath, exists = future.result()
+            except requests.RequestException:
+                filepath, exists = None, False
             
             if filepath:
                 if exists:
@@ -197,8 +172,6 @@ def main():
                     print(f"  [new]  {date.year}-{date.month:02d} ${bill['adjustedBillAmount']:>7.2f}")
             else:
                 print(f"  [fail] {date.year}-{date.month:02d}")
-            
-            time.sleep(0.3)
     
     save_billing_data(bills)
     print_summary(bills, downloaded, skipped)
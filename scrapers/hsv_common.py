@@ -0,0 +1,369 @@
+import requests
+import json
+import time
+import random
+from datetime import datetime, timedelta
+import os
+from dotenv import load_dotenv
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+load_dotenv()
+USERNAME = os.getenv("HSV_USERNAME")
+PASSWORD = os.getenv("HSV_PASSWORD")
+
+BASE_URL = "https://hsvutil.smarthub.coop"
+TOKEN_FILE = "hsv_token.json"
+META_FILE = "hsv_meta.json"
+
+TOKEN_EXPIRY_MARGIN = timedelta(seconds=60)
+
+# account and data start rarely change, re-check them monthly
+META_TTL = timedelta(days=30)
+
+# poll backoff: start fast, grow by half up to the cap (the old fixed
+# interval), give up after the timeout
+POLL_INITIAL_DELAY = 0.25
+POLL_BACKOFF = 1.5
+POLL_MAX_DELAY = 2.0
+POLL_TIMEOUT = 60
+
+# gateway errors while polling are retried on the same backoff, but only
+# this many in a row
+POLL_RETRY_STATUSES = (502, 503, 504)
+POLL_MAX_ERRORS = 3
+
+# usage poll fields that never change between calls
+USAGE_PAYLOAD = {
+    "userId": USERNAME,
+    "screen": "USAGE_EXPLORER",
+    "includeDemand": False
+}
+
+def convert_interval(interval):
+    if interval == "15_MIN":
+        return "FIFTEEN_MINUTE"
+    return interval
+
+def save_token(token_data):
+    # every hsv script reuses this token, keep it readable by the owner only.
+    # the mode passed to open only applies to a new file, so tighten one
+    # left behind by an older run too
+    fd = os.open(TOKEN_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({
+            'token': token_data['authorizationToken'],
+            'expiration': token_data['expiration'],
+            'timestamp': datetime.now().isoformat()
+        }, f)
+
+def load_token():
+    if os.path.exists(TOKEN_FILE):
+        with open(TOKEN_FILE, 'r') as f:
+            data = json.load(f)
+            exp = datetime.fromtimestamp(data['expiration'] / 1000)
+            # leave a minute of slack so the token can't lapse mid-run
+            if exp > datetime.now() + TOKEN_EXPIRY_MARGIN:
+                return data['token']
+    return None
+
+def load_cached_meta():
+    """account/location (and probed data start) cached from an earlier run, {} if stale"""
+    if not os.path.exists(META_FILE):
+        return {}
+    with open(META_FILE, 'r') as f:
+        data = json.load(f)
+    try:
+        saved = datetime.fromisoformat(data['timestamp'])
+    except (KeyError, TypeError, ValueError):
+        return {}
+    if data.get('user') != USERNAME or datetime.now() - saved > META_TTL:
+        return {}
+    return data
+
+def save_cached_meta(meta):
+    with open(META_FILE, 'w') as f:
+        json.dump({**meta, 'user': USERNAME, 'timestamp': datetime.now().isoformat()}, f)
+
+def clear_cached_meta():
+    try:
+        os.remove(META_FILE)
+    except FileNotFoundError:
+        pass
+
+def clear_token():
+    try:
+        os.remove(TOKEN_FILE)
+    except FileNotFoundError:
+        pass
+
+def create_session(use_cache=True):
+    session = requests.Session()
+    # warm connections for the concurrent polls; transient gateway errors and
+    # 429s (honouring Retry-After) are retried here on GETs only. the usage
+    # poll is a POST, get_usage_data retries its gateway errors itself
+    retries = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=frozenset({"GET"}),
+        raise_on_status=False
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retries))
+    
+    # try existing token; load_token already dropped expired ones, so trust
+    # it and let the first real call catch a revoked token
+    token = load_token() if use_cache else None
+    if token:
+        session.headers.update({'Authorization': f'Bearer {token}'})
+        print("using cached token")
+        return session
+    
+    # fresh login
+    response = session.post(f"{BASE_URL}/login", data={"username": USERNAME, "password": PASSWORD}, 
+                          headers={"User-Agent": "Mozilla/5.0"}, allow_redirects=True)
+    
+    if not ("/ui/" in response.url or "dashboard" in response.url.lower()):
+        return None
+    
+    response = session.post(f"{BASE_URL}/services/oauth/auth/v2", 
+                          data=f"userId={urllib.parse.quote(USERNAME)}&password={urllib.parse.quote(PASSWORD)}",
+                          headers={"Content-Type": "application/x-www-form-urlencoded"})
+    
+    if response.status_code != 200:
+        return None
+    
+    token_data = response.json()
+    token = token_data.get("authorizationToken")
+    if not token:
+        return None
+    
+    save_token(token_data)
+    session.headers.update({'Authorization': f'Bearer {token}'})
+    print("login successful")
+    return session
+
+def get_account_info(session):
+    """(account number, service location), None if the token was rejected"""
+    response = session.get(f"{BASE_URL}/services/secured/accounts", params={"user": USERNAME})
+    if response.status_code == 401:
+        return None
+    accounts = response.json()
+    
+    account_number = str(accounts[0]["account"])
+    service_location = str(accounts[0]["serviceLocations"][0])
+    
+    return account_number, service_location
+
+def login_and_get_account(session):
+    """(session, (account number, service location)) for a session from
+    create_session; a cached token rejected here gets one fresh login, and
+    the session returned is the one to keep using. (None, None) if that
+    fails too"""
+    account_info = get_account_info(session)
+    if account_info is None:
+        # cached token was revoked early, log in once more from scratch
+        print("cached token rejected, logging in again")
+        clear_token()
+        session = create_session(use_cache=False)
+        account_info = get_account_info(session) if session else None
+    if account_info is None:
+        return None, None
+    return session, account_info
+
+def get_usage_data(session, account_number, service_location, start_date, end_date, time_frame="HOURLY", industries=None):
+    if industries is None:
+        industries = ["WATER", "ELECTRIC", "GAS"]
+    
+    if isinstance(start_date, str):
+        start_date = datetime.strptime(start_date, "%Y-%m-%d")
+    if isinstance(end_date, str):
+        end_date = datetime.strptime(end_date, "%Y-%m-%d")
+    
+    start_ms = int(start_date.timestamp() * 1000)
+    end_ms = int(end_date.timestamp() * 1000)
+    
+    payload = {
+        **USAGE_PAYLOAD,
+        "timeFrame": time_frame,
+        "serviceLocationNumber": service_location,
+        "accountNumber": account_number,
+        "industries": industries,
+        "startDateTime": start_ms,
+        "endDateTime": end_ms
+    }
+    # the body is the same for the submit and every poll, encode it once
+    body = json.dumps(payload, separators=(',', ':'))
+    headers = {"Content-Type": "application/json"}
+    
+    # most jobs finish in well under a second, so check back quickly and
+    # only slow down for the long ones; jitter keeps concurrent polls apart.
+    # the submit and every poll are the same request for the same report,
+    # so a gateway error on any of them is just tried again
+    delay = POLL_INITIAL_DELAY
+    deadline = time.monotonic() + POLL_TIMEOUT
+    errors = 0
+    while True:
+        response = session.post(f"{BASE_URL}/services/secured/utility-usage/poll", data=body, headers=headers)
+        if response.status_code in POLL_RETRY_STATUSES and errors < POLL_MAX_ERRORS:
+            errors += 1
+        else:
+            # an error status is a real failure and shouldn't surface as a
+            # json decode error
+            response.raise_for_status()
+            errors = 0
+            data = response.json()
+            if data.get("status") in ("COMPLETE", "FAILED"):
+                break
+        
+        if time.monotonic() >= deadline:
+            # out of time on a gateway error: report that, not a timeout
+            response.raise_for_status()
+            break
+        time.sleep(delay * random.uniform(0.8, 1.2))
+        delay = min(delay * POLL_BACKOFF, POLL_MAX_DELAY)
+    
+    if data.get("status") == "FAILED":
+        raise RuntimeError("usage report failed on the server")
+    if data.get("status") != "COMPLETE":
+        raise TimeoutError(f"usage report not ready after {POLL_TIMEOUT}s")
+    
+    return process_usage_data(data)
+
+def error_status(error):
+    """http status a request failed with, None for anything else"""
+    response = getattr(error, "response", None)
+    if isinstance(error, requests.HTTPError) and response is not None:
+        return response.status_code
+    return None
+
+def is_unauthorized(error):
+    """true if a request failed because the token was rejected"""
+    return error_status(error) == 401
+
+def fetch_usage(session, account_number, service_location, jobs, max_workers):
+    """run get_usage_data for every job side by side
+
+    jobs maps a key to (start, end, time_frame, industry); the result maps each
+    key to its data, or to the exception it raised, so one failed industry or
+    window doesn't sink the rest of the run. jobs rejected with a 401 are
+    retried once on a fresh login
+    """
+    def run(session, jobs):
+        results = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                key: executor.submit(
+                    get_usage_data, session, account_number, service_location,
+                    start, end, time_frame, industries=[industry]
+                )
+                for key, (start, end, time_frame, industry) in jobs.items()
+            }
+            for key, future in futures.items():
+                try:
+                    results[key] = future.result()
+                except Exception as e:
+                    results[key] = e
+        return results
+    
+    results = run(session, jobs)
+    
+    # clean up once here rather than in every worker: a 401 or 404 means the
+    # cached account/location may be stale, look them up again next run
+    if any(error_status(result) in (401, 404) for result in results.values()):
+        clear_cached_meta()
+    
+    # with the account cached, the usage calls are the first to see an
+    # expired or revoked token; drop it so a failed login isn't retried
+    # with it next run
+    rejected = {key: jobs[key] for key, result in results.items() if is_unauthorized(result)}
+    if rejected:
+        print("cached token rejected, logging in again")
+        clear_token()
+        session = create_session(use_cache=False)
+        if session:
+            results.update(run(session, rejected))
+    return results
+
+def points_to_readings(points):
+    """turn series points ({x: epoch ms, y: usage}) into reading dicts"""
+    fromtimestamp = datetime.fromtimestamp
+    return [
+        {
+            "timestamp": point.get("x"),
+            "datetime": fromtimestamp(point.get("x", 0) / 1000).isoformat(),
+            "usage": point.get("y", 0)
+        }
+        for point in points
+    ]
+
+def process_usage_data(data):
+    processed = {}
+
+    for industry, industry_data in data["data"].items():
+        if not industry_data:
+            continue
+        
+        processed[industry] = []
+
+        for service_data in industry_data:
+            meters_info = service_data.get("meters", [])
+            series_data = service_data.get("series", [])
+
+            if meters_info and series_data:
+                # index the series by meter once; setdefault keeps the first
+                # match, like the linear scan it replaces
+                series_by_name = {}
+                for series in series_data:
+                    series_by_name.setdefault(series.get("name"), series)
+                
+                for meter_info in meters_info:
+                    meter_number = meter_info.get("meterNumber")
+                    meter_series = series_by_name.get(meter_number)
+
+                    readings = []
+                    if meter_series and meter_series.get("data"):
+                        readings = points_to_readings(meter_series["data"])
+
+                    processed[industry].append({
+                        "meterNumber": meter_number,
+                        "unitOfMeasure": meter_info.get("unitOfMeasure"),
+                        "flowDirection": meter_info.get("flowDirection"),
+                        "isNetMeter": meter_info.get("isNetMeter", False),
+                        "totalReadings": len(readings),
+                        "readings": readings
+                    })
+
+            elif industry == "WATER":
+                readings = []
+                unit_of_measure = service_data.get("unitOfMeasure", "GAL")
+                
+                if "data" in service_data and isinstance(service_data["data"], list):
+                    readings = points_to_readings(
+                        point for point in service_data["data"]
+                        if isinstance(point, dict) and "x" in point and "y" in point
+                    )
+                
+                current = service_data.get("current")
+                if current and not readings:
+                    readings.append({
+                        "timestamp": None,
+                        "datetime": f"{current.get('month', 0)}/{current.get('year', 0)}",
+                        "usage": current.get("usage", 0)
+                    })
+                    unit_of_measure = current.get("unitsOfMeasure", [unit_of_measure])[0]
+
+                if readings:
+                    processed[industry].append({
+                        "meterNumber": service_data.get("serviceLocationNumber", "UNKNOWN"),
+                        "unitOfMeasure": unit_of_measure,
+                        "flowDirection": "DELIVERED",
+                        "isNetMeter": False,
+                        "totalReadings": len(readings),
+                        "readings": readings
+                    })
+
+    return processed
@@ -1,248 +1,135 @@
-import requests
 import json
-import time
+import gzip
 from datetime import datetime, timedelta
 import os
+import shutil
 from pathlib import Path
-from dotenv import load_dotenv
-import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from hsv_common import (
+    convert_interval,
+    load_cached_meta,
+    save_cached_meta,
+    clear_cached_meta,
+    clear_token,
+    create_session,
+    login_and_get_account,
+    get_usage_data,
+    fetch_usage,
+    error_status,
+    is_unauthorized,
+)
 
-load_dotenv()
-USERNAME = os.getenv("HSV_USERNAME")
-PASSWORD = os.getenv("HSV_PASSWORD")
+# hsv_common already loaded .env on import
 DATA_PERIOD_DAYS = int(os.getenv("DATA_PERIOD_DAYS", "7"))
 ELECTRIC_INTERVAL = os.getenv("ELECTRIC_INTERVAL", "HOURLY")
 GAS_INTERVAL = os.getenv("GAS_INTERVAL", "HOURLY") 
 WATER_INTERVAL = os.getenv("WATER_INTERVAL", "MONTHLY")
 
-BASE_URL = "https://hsvutil.smarthub.coop"
-TOKEN_FILE = "hsv_token.json"
-
-def convert_interval(interval):
-    if interval == "15_MIN":
-        return "FIFTEEN_MINUTE"
-    return interval
-
-def save_token(token_data):
-    with open(TOKEN_FILE, 'w') as f:
-        json.dump({
-            'token': token_data['authorizationToken'],
-            'expiration': token_data['expiration'],
-            'timestamp': datetime.now().isoformat()
-        }, f)
-
-def load_token():
-    if os.path.exists(TOKEN_FILE):
-        with open(TOKEN_FILE, 'r') as f:
-            data = json.load(f)
-            exp = datetime.fromtimestamp(data['expiration'] / 1000)
-            if exp > datetime.now():
-                return data['token']
-    return None
-
-def create_session():
-    session = requests.Session()
-    
-    # try existing token
-    token = load_token()
-    if token:
-        session.headers.update({'Authorization': f'Bearer {token}'})
-        try:
-            response = session.get(f"{BASE_URL}/services/secured/accounts", params={"user": USERNAME})
-            if response.status_code == 200:
-                print("using cached token")
-                return session
-        except:
-            pass
-    
-    # fresh login
-    response = session.post(f"{BASE_URL}/login", data={"username": USERNAME, "password": PASSWORD}, 
-                          headers={"User-Agent": "Mozilla/5.0"}, allow_redirects=True)
-    
-    if not ("/ui/" in response.url or "dashboard" in response.url.lower()):
-        return None
-    
-    response = session.post(f"{BASE_URL}/services/oauth/auth/v2", 
-                          data=f"userId={urllib.parse.quote(USERNAME)}&password={urllib.parse.quote(PASSWORD)}",
-                          headers={"Content-Type": "application/x-www-form-urlencoded"})
-    
-    if response.status_code != 200:
-        return None
-    
-    token_data = response.json()
-    token = token_data.get("authorizationToken")
-    if not token:
-        return None
-    
-    save_token(token_data)
-    session.headers.update({'Authorization': f'Bearer {token}'})
-    print("login successful")
-    return session
-
-def get_account_info(session):
-    response = session.get(f"{BASE_URL}/services/secured/accounts", params={"user": USERNAME})
-    accounts = response.json()
-    
-    account_number = str(accounts[0]["account"])
-    service_location = str(accounts[0]["serviceLocations"][0])
-    print(f"account: {account_number}, service location: {service_location}")
-    
-    return account_number, service_location
+CHUNK_WORKERS = 4
+PROBE_WORKERS = 3
 
 def check_data_availability(session, account_number, service_location):
     print("\nchecking data availability...")
     
     end_date = datetime.now()
-    test_periods = [30, 90, 180, 365, 540]
+    max_days = 540
     earliest_with_data = None
     
-    for days in test_periods:
+    def probe_window(days):
         test_start = end_date - timedelta(days=days)
-        test_end = min(test_start + timedelta(days=30), end_date)
-        
-        try:
-            data = get_usage_data(session, account_number, service_location,
-                                test_start, test_end, "DAILY", ["ELECTRIC"])
+        return test_start, min(test_start + timedelta(days=30), end_date)
+    
+    def daily_readings(start, end):
+        # request errors propagate: a failed probe isn't "no data", and a
+        # rejected token is for main to log in again
+        data = get_usage_data(session, account_number, service_location,
+                            start, end, "DAILY", ["ELECTRIC"])
+        meters = data.get("ELECTRIC") if data else None
+        return meters[0].get("readings", []) if meters else []
+    
+    def has_data(days):
+        return len(daily_readings(*probe_window(days))) > 5
+    
+    # history is contiguous, so search for the oldest window with data: each
+    # round probes a few evenly spaced points side by side and narrows to the
+    # gap between the last hit and first miss
+    lo, hi = 0, max_days + 1
+    with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as executor:
+        while hi - lo > 30:
+            step = (hi - lo) / (PROBE_WORKERS + 1)
+            points = sorted({lo + round(step * i) for i in range(1, PROBE_WORKERS + 1)})
             
-            if data and "ELECTRIC" in data and data["ELECTRIC"]:
-                meter = data["ELECTRIC"][0]
-                if meter.get("totalReadings", 0) > 5:
-                    earliest_with_data = test_start
-                    print(f"  data found at {test_start.date()} ({days} days)")
-        except:
-            pass
-        
-        time.sleep(0.3)
+            for days, found in zip(points, executor.map(has_data, points)):
+                if not found:
+                    hi = days
+                    break
+                lo = days
+                earliest_with_data = probe_window(days)[0]
+                print(f"  data found at {earliest_with_data.date()} ({days} days)")
     
     if earliest_with_data:
+        # the window at hi had (next to) no readings and the one at lo had
+        # plenty, so the real start lies between the start of the first and
+        # the end of the second; one daily fetch over that stretch holds it.
+        # if every probe hit, begin at max_days like the old fixed ladder did
+        bracket_start = end_date - timedelta(days=min(hi, max_days))
+        bracket_end = min(end_date - timedelta(days=lo - 31), end_date)
+        readings = [r for r in daily_readings(bracket_start, bracket_end) if r.get("timestamp")]
+        
+        if readings:
+            actual_start = datetime.fromtimestamp(readings[0]["timestamp"] / 1000)
+            actual_start = actual_start.replace(hour=0, minute=0, second=0, microsecond=0)
+            days_available = (end_date - actual_start).days
+            print(f"earliest data: {actual_start.date()}")
+            print(f"total days available: {days_available}")
+            return actual_start, days_available
+        
         days_available = (end_date - earliest_with_data).days
-        print(f"earliest data: {earliest_with_data.date()}")
-        print(f"total days available: {days_available}")
+        print(f"earliest data: ~{earliest_with_data.date()}")
+        print(f"total days available: ~{days_available}")
         return earliest_with_data, days_available
     
-    print("no historical data found, defaulting to 30 days")
-    return end_date - timedelta(days=30), 30
-
-def get_usage_data(session, account_number, service_location, start_date, end_date, time_frame="HOURLY", industries=None):
-    if industries is None:
-        industries = ["WATER", "ELECTRIC", "GAS"]
-    
-    if isinstance(start_date, str):
-        start_date = datetime.strptime(start_date, "%Y-%m-%d")
-    if isinstance(end_date, str):
-        end_date = datetime.strptime(end_date, "%Y-%m-%d")
-    
-    start_ms = int(start_date.timestamp() * 1000)
-    end_ms = int(end_date.timestamp() * 1000)
-    
-    payload = {
-        "timeFrame": time_frame,
-        "userId": USERNAME,
-        "screen": "USAGE_EXPLORER",
-        "includeDemand": False,
-        "serviceLocationNumber": service_location,
-        "accountNumber": account_number,
-        "industries": industries,
-        "startDateTime": start_ms,
-        "endDateTime": end_ms
-    }
-    
-    response = session.post(f"{BASE_URL}/services/secured/utility-usage/poll", json=payload)
-    data = response.json()
-    
-    retries = 30
-    while data.get("status") != "COMPLETE" and retries > 0:
-        time.sleep(2)
-        response = session.post(f"{BASE_URL}/services/secured/utility-usage/poll", json=payload)
-        data = response.json()
-        retries -= 1
-    
-    return process_usage_data(data)
-
-def process_usage_data(data):
-    processed = {}
-
-    for industry, industry_data in data["data"].items():
-        if not industry_data:
-            continue
-        
-        processed[industry] = []
-
-        for service_data in industry_data:
-            meters_info = service_data.get("meters", [])
-            series_data = service_data.get("series", [])
-
-            if meters_info and series_data:
-                for meter_info in meters_info:
-                    meter_number = meter_info.get("meterNumber")
-                    meter_series = next((s for s in series_data if s.get("name") == meter_number), None)
-
-                    readings = []
-                    if meter_series and meter_series.get("data"):
-                        for point in meter_series["data"]:
-                            readings.append({
-                                "timestamp": point.get("x"),
-                                "datetime": datetime.fromtimestamp(point.get("x", 0) / 1000).isoformat(),
-                                "usage": point.get("y", 0)
-                            })
-
-                    processed[industry].append({
-                        "meterNumber": meter_number,
-                        "unitOfMeasure": meter_info.get("unitOfMeasure"),
-                        "flowDirection": meter_info.get("flowDirection"),
-                        "isNetMeter": meter_info.get("isNetMeter", False),
-                        "totalReadings": len(readings),
-                        "readings": readings
-                    })
-
-            elif industry == "WATER":
-                readings = []
-                unit_of_measure = service_data.get("unitOfMeasure", "GAL")
-                
-                if "data" in service_data and isinstance(service_data["data"], list):
-                    for point in service_data["data"]:
-                        if isinstance(point, dict) and "x" in point and "y" in point:
-                            readings.append({
-                                "timestamp": point.get("x"),
-                                "datetime": datetime.fromtimestamp(point.get("x", 0) / 1000).isoformat(),
-                                "usage": point.get("y", 0)
-                            })
-                
-                current = service_data.get("current")
-                if current and not readings:
-                    readings.append({
-                        "timestamp": None,
-                        "datetime": f"{current.get('month', 0)}/{current.get('year', 0)}",
-                        "usage": current.get("usage", 0)
-                    })
-                    unit_of_measure = current.get("unitsOfMeasure", [unit_of_measure])[0]
-
-                if readings:
-                    processed[industry].append({
-                        "meterNumber": service_data.get("serviceLocationNumber", "UNKNOWN"),
-                        "unitOfMeasure": unit_of_measure,
-                        "flowDirection": "DELIVERED",
-                        "isNetMeter": False,
-                        "totalReadings": len(readings),
-                        "readings": readings
-                    })
+    return None
 
-    return processed
+def compress_backups(data_dir):
+    """gzip every backup but the newest; none are ever deleted"""
+    # older runs wrote hsu_usage_*; both prefixes are the same length and the
+    # names end in the timestamp, so name order is save order
+    backups = sorted(
+        [*data_dir.glob("hsv_usage_*.json*"), *data_dir.glob("hsu_usage_*.json*")],
+        key=lambda p: p.name[len("hsv_usage_"):]
+    )
+    
+    for path in backups[:-1]:
+        if path.suffix == ".json":
+            with open(path, 'rb') as src, gzip.open(f"{path}.gz", 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            path.unlink()
 
 def save_data(data):
     data_dir = Path("data/utilities")
     data_dir.mkdir(parents=True, exist_ok=True)
     
-    # save as current file for incremental updates
+    payload = json.dumps(data, separators=(',', ':'))
+    
+    # current file, which hsv_scraper_incremental merges into
     current_file = data_dir / "hsv_current.json"
-    with open(current_file, 'w') as f:
-        json.dump(data, f, indent=2)
+    tmp_file = current_file.with_suffix(".json.tmp")
+    tmp_file.write_text(payload)
+    os.replace(tmp_file, current_file)
     
-    # also save timestamped backup
+    # also save timestamped backup, a hard link to hsv_current.json (copied
+    # where the filesystem has no links)
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_file = data_dir / f"hsu_usage_{timestamp}.json"
-    with open(backup_file, 'w') as f:
-        json.dump(data, f, indent=2)
+    backup_file = data_dir / f"hsv_usage_{timestamp}.json"
+    try:
+        os.link(current_file, backup_file)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copyfile(current_file, backup_file)
+    
+    compress_backups(data_dir)
     
     print(f"\ndata saved to {current_file}")
     print(f"backup saved to {backup_file}")
@@ -259,7 +146,7 @@ def print_summary(data):
         for meter in meters:
             total_usage = sum(r.get("usage", 0) for r in meter.get("readings", []))
             unit = meter.get("unitOfMeasure", "UNKNOWN")
-            readings_count = meter.get("totalReadings", 0)
+            readings_count = len(meter.get("readings", []))
             print(f"  meter {meter['meterNumber']}: {readings_count} readings, {total_usage:.2f} {unit}")
             
             if readings_count > 0 and meter["readings"][0].get("datetime"):
@@ -278,14 +165,52 @@ def main():
         print("\nauthentication failed")
         return
     
-    account_number, service_location = get_account_info(session)
+    meta = load_cached_meta()
+    if meta.get("account_number") and meta.get("service_location"):
+        account_number, service_location = meta["account_number"], meta["service_location"]
+        print(f"account: {account_number}, service location: {service_location} (cached)")
+    else:
+        session, account_info = login_and_get_account(session)
+        if account_info is None:
+            print("\nauthentication failed")
+            return
+        account_number, service_location = account_info
+        print(f"account: {account_number}, service location: {service_location}")
+        meta = {"account_number": account_number, "service_location": service_location}
+        save_cached_meta(meta)
     
     # date range
     end_date = datetime.now()
     
     if DATA_PERIOD_DAYS < 0:
-        actual_start, days_available = check_data_availability(session, account_number, service_location)
-        start_date = actual_start
+        if meta.get("earliest_with_data"):
+            # the start of history doesn't move, reuse the last probe
+            start_date = datetime.fromisoformat(meta["earliest_with_data"])
+            days_available = (end_date - start_date).days
+            print(f"\nearliest data: {start_date.date()} (cached)")
+        else:
+            try:
+                found = check_data_availability(session, account_number, service_location)
+            except Exception as e:
+                if error_status(e) == 404:
+                    # the cached account/location is stale, look them up again next run
+                    clear_cached_meta()
+                if not is_unauthorized(e):
+                    raise
+                print("cached token rejected, logging in again")
+                clear_token()
+                session = create_session(use_cache=False)
+                if not session:
+                    print("\nauthentication failed")
+                    return
+                found = check_data_availability(session, account_number, service_location)
+            if found:
+                start_date, days_available = found
+                save_cached_meta({**meta, "earliest_with_data": start_date.isoformat()})
+            else:
+                # nothing to remember, the next run probes again
+                print("no historical data found, defaulting to 30 days")
+                start_date, days_available = end_date - timedelta(days=30), 30
         print(f"\nfetching all available data ({days_available} days)")
     else:
         print(f"\nfetching last {DATA_PERIOD_DAYS} days")
@@ -308,59 +233,89 @@ def main():
     
     if days_to_fetch <= max_chunk_size:
         print(f"\nfetching utilities...")
+        # each industry spends most of its time waiting on the poll endpoint,
+        # so poll them all at once and report in the usual order
+        results = fetch_usage(
+            session, account_number, service_location,
+            {industry: (start_date, end_date, interval, industry) for industry, interval in intervals.items()},
+            max_workers=len(intervals)
+        )
+        
         for industry, interval in intervals.items():
-            print(f"  {industry} ({interval})", end="", flush=True)
-            data = get_usage_data(
-                session, account_number, service_location,
-                start_date, end_date, interval, industries=[industry]
-            )
-            if data and industry in data:
+            data = results[industry]
+            if isinstance(data, Exception):
+                print(f"  {industry} ({interval}) - error: {data}")
+            elif data and industry in data:
                 all_data[industry] = data[industry]
-                total_readings = sum(m.get("totalReadings", 0) for m in data[industry])
-                print(f" - {total_readings} readings")
+                total_readings = sum(len(m["readings"]) for m in data[industry])
+                print(f"  {industry} ({interval}) - {total_readings} readings")
+            else:
+                print(f"  {industry} ({interval}) - no data")
     else:
         print(f"\nfetching in chunks...")
-        total_chunks = (days_to_fetch // max_chunk_size) + 1
+        
+        # windows newest first, all handed to fetch_usage at once
+        windows = []
+        current_end = end_date
+        while current_end > start_date:
+            current_start = max(current_end - timedelta(days=max_chunk_size - 1), start_date)
+            windows.append((current_start, current_end))
+            current_end = current_start - timedelta(days=1)
+        
+        total_chunks = len(windows)
+        
+        # chunks spend nearly all their time waiting on the poll endpoint; the
+        # pool size is what bounds the load on the server
+        results = fetch_usage(
+            session, account_number, service_location,
+            {
+                (industry, chunk_num): (window_start, window_end, interval, industry)
+                for industry, interval in intervals.items()
+                for chunk_num, (window_start, window_end) in enumerate(windows, 1)
+            },
+            max_workers=CHUNK_WORKERS
+        )
         
         for industry, interval in intervals.items():
             print(f"\n{industry} ({interval}):")
             industry_data = []
+            chunks_by_meter = {}
             
-            current_end = end_date
-            chunk_num = 1
-            
-            while current_end > start_date:
-                current_start = max(current_end - timedelta(days=max_chunk_size - 1), start_date)
-                
-                print(f"  chunk {chunk_num}/{total_chunks}: {current_start.date()} to {current_end.date()}", end="", flush=True)
-                
-                chunk_data = get_usage_data(
-                    session, account_number, service_location,
-                    current_start, current_end, interval, industries=[industry]
-                )
+            # collect in window order (newest first); a failed chunk is
+            # reported and left out, the rest are still saved
+            for chunk_num, (current_start, current_end) in enumerate(windows, 1):
+                label = f"  chunk {chunk_num}/{total_chunks}: {current_start.date()} to {current_end.date()}"
+                chunk_data = results[(industry, chunk_num)]
                 
-                if chunk_data and industry in chunk_data:
+                if isinstance(chunk_data, Exception):
+                    print(f"{label} - error: {chunk_data}")
+                elif chunk_data and industry in chunk_data:
                     for meter in chunk_data[industry]:
-                        existing_meter = next(
-                            (m for m in industry_data if m["meterNumber"] == meter["meterNumber"]), 
-                            None
-                        )
-                        if existing_meter:
-                            existing_meter["readings"] = meter["readings"] + existing_meter["readings"]
-                            existing_meter["totalReadings"] = len(existing_meter["readings"])
-                        else:
+                        chunks = chunks_by_meter.get(meter["meterNumber"])
+                        if chunks is None:
+                            chunks_by_meter[meter["meterNumber"]] = chunks = []
                             industry_data.append(meter)
+                        chunks.append(meter["readings"])
                     
-                    readings_count = sum(m.get("totalReadings", 0) for m in chunk_data[industry])
-                    print(f" - {readings_count} readings")
-                
-                current_end = current_start - timedelta(days=1)
-                chunk_num += 1
-                time.sleep(0.5)
+                    readings_count = sum(len(m["readings"]) for m in chunk_data[industry])
+                    print(f"{label} - {readings_count} readings")
+                else:
+                    print(f"{label} - no data")
             
             if industry_data:
+                # stitch each meter's chunks back together oldest first in
+                # one pass, then set the saved count once
+                for meter in industry_data:
+                    chunks = chunks_by_meter[meter["meterNumber"]]
+                    meter["readings"] = [r for chunk in reversed(chunks) for r in chunk]
+                    meter["totalReadings"] = len(meter["readings"])
                 all_data[industry] = industry_data
     
+    if not all_data:
+        # nothing came back, don't replace the last good file with an empty one
+        print("\nno data fetched, keeping the existing files")
+        return
+    
     print_summary(all_data)
     save_data(all_data)
     print("\ncollection complete")
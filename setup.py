@@ -15,10 +15,10 @@ def install_requirements():
         'pyyaml>=6.0'
     ]
     
+    # one pip run resolves everything together instead of once per package
     print("installing required packages...")
-    for package in requirements:
-        subprocess.check_call([sys.executable, '-m', 'pip', 'install', package])
-        print(f"installed {package}")
+    subprocess.check_call([sys.executable, '-m', 'pip', 'install', '--no-input', *requirements])
+    print(f"installed {', '.join(requirements)}")
     
     return True
 
@@ -135,7 +135,7 @@ from pathlib import Path
 def test_data_files():
     print("testing data files...")
     
-    hsv_files = list(Path("data/utilities").glob("hsu_usage_*.json"))
+    hsv_files = list(Path("data/utilities").glob("hsv_usage_*.json"))
     ecobee_files = list(Path("data/ecobee").glob("ecobee_data_*.json"))
     
     if not hsv_files: